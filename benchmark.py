@@ -0,0 +1,309 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+# run without a window or a sound card
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numba
+import numpy as np
+import pygame as pg
+from settings import *
+from entities import Entities, draw_entities
+from memory import memory_report, format_memory_report
+from player import Player
+from lighting import bake_shade, sun_position
+from voxel_render import (VoxelRender, repeat_tiles, load_tile, load_map, extract_minimap,
+                          ray_casting, ray_casting_depth_major, draw_dashed_line,
+                          bake_color_map, paint_landing_area, build_flatness_index)
+
+###############################################################################
+# VOXEL SKIES - micro benchmarks
+# Times the hot kernels one by one against the bundled maps, from fixed camera
+# states, and compares the steady-state times with a baseline file.
+###############################################################################
+
+BASELINE_FILE = 'benchmark_baseline.json'
+DEFAULT_THRESHOLD = 0.25
+
+# fixed camera states: position, angle, height, pitch
+CAMERAS = {
+    'start': ((MAP_SIZE*NUM_TILES/2, MAP_SIZE*NUM_TILES/2), -math.pi/2, 250, 0),
+    'low': ((MAP_SIZE*3.2, MAP_SIZE*2.6), 0.7, 120, 80),
+    'high': ((MAP_SIZE*4.5, MAP_SIZE*3.8), 2.3, 400, -100),
+}
+
+class Context:
+    def __init__(self, low_memory=False):
+        self.map_id = 0
+        self.low_memory = low_memory
+        self.screen = pg.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        self._voxel_render = None
+
+    def tile(self, kind):
+        return load_tile('img/map'+str(self.map_id)+'_'+kind+'.png')
+
+    # a renderer with its player, on the current map (with the same landing area every run)
+    def voxel_render(self):
+        if self._voxel_render is None:
+            np.random.seed(0)
+            random.seed(0)
+            app = SimpleNamespace(width=WINDOW_WIDTH, height=WINDOW_HEIGHT, screen=self.screen,
+                                  player=Player(), explosion=None, entities=Entities(),
+                                  low_memory=self.low_memory)
+            app.voxel_render = self._voxel_render = VoxelRender(app)
+        if self._voxel_render.map_id != self.map_id:
+            random.seed(self.map_id)
+            self._voxel_render.map_id = self.map_id
+            self._voxel_render.load_level()
+        return self._voxel_render
+
+def tiles(ctx):
+    tile = ctx.tile('color')
+    return lambda: repeat_tiles(tile, 10)
+
+def shade(ctx):
+    height_tile = ctx.tile('height')
+    sun = sun_position(TIME_OF_DAY)
+    return lambda: bake_shade(height_tile, 0, height_tile.shape[0], 0, height_tile.shape[1], *sun)
+
+def color_map(ctx):
+    vr = ctx.voxel_render()
+    sun = sun_position(vr.time_of_day)
+    return lambda: bake_color_map(vr.color_tile, vr.height_tile, vr.height_map,
+                                  vr.player.landing_area_pos, *sun, vr.num_tiles)
+
+def render(ctx, camera, nvg, kernel=ray_casting):
+    vr = ctx.voxel_render()
+    pos, angle, height, pitch = CAMERAS[camera]
+    pos = np.array(pos, dtype=float)
+    return lambda: kernel(vr.screen_array, vr.depth_buffer, pos, angle, height, pitch,
+                          WINDOW_WIDTH, WINDOW_HEIGHT, vr.delta_angle, vr.ray_distance,
+                          vr.h_fov, vr.scale_height, vr.color_map, vr.height_map, vr.sky, 0, nvg)
+
+def minimap(ctx):
+    vr = ctx.voxel_render()
+    return lambda: extract_minimap(vr.color_map, *CAMERAS['start'][0])
+
+def landing_area(ctx):
+    vr = ctx.voxel_render()
+    flatness_index = build_flatness_index(vr.height_tile)
+    random.seed(ctx.map_id)
+    return lambda: vr.create_landing_area(flatness_index)
+
+def level(ctx, cached):
+    vr = ctx.voxel_render()
+
+    def load():
+        # same level load as change_map, with or without the lighting in the cache
+        if not cached:
+            vr.lit_tiles.clear()
+        random.seed(ctx.map_id)
+        vr.load_level()
+    return load
+
+def landing_area_paint(ctx):
+    vr = ctx.voxel_render()
+    return lambda: paint_landing_area(vr.color_map, *vr.player.landing_area_pos)
+
+def dashed_line(ctx):
+    return lambda: draw_dashed_line(ctx.screen, HUD_COLOR, (100, 50), (700, 310), 1, 5)
+
+def draw_player(ctx):
+    vr = ctx.voxel_render()
+    vr.player.roll = 30
+    vr.player.speed = 10
+    return vr.draw_player
+
+def draw_aircraft(ctx, camera):
+    vr = ctx.voxel_render()
+    pos, angle, height, pitch = CAMERAS[camera]
+    pos = np.array(pos, dtype=float)
+
+    # aircraft spread in the field of view of the camera, the same on every run
+    rng = np.random.default_rng(0)
+    entities = Entities()
+    count = len(entities.pos)
+    ray_angle = angle - vr.h_fov + rng.uniform(0, WINDOW_WIDTH * vr.delta_angle, count)
+    distance = rng.uniform(50, vr.ray_distance / 2, count)
+    entities.pos[:, 0] = pos[0] + distance * np.cos(ray_angle)
+    entities.pos[:, 1] = pos[1] + distance * np.sin(ray_angle)
+    entities.height[:] = height - rng.uniform(0, 100, count)
+    entities.frame[:] = rng.integers(0, 4, count)
+
+    ray_casting(vr.screen_array, vr.depth_buffer, pos, angle, height, pitch,
+                WINDOW_WIDTH, WINDOW_HEIGHT, vr.delta_angle, vr.ray_distance,
+                vr.h_fov, vr.scale_height, vr.color_map, vr.height_map, vr.sky, 0, False)
+    screen_array = vr.screen_array.copy()
+    depth_buffer = vr.depth_buffer.copy()
+
+    def draw():
+        # every call draws over the same terrain (includes copying the frame back)
+        vr.screen_array[:] = screen_array
+        vr.depth_buffer[:] = depth_buffer
+        draw_entities(vr.screen_array, vr.depth_buffer, entities.pos, entities.height,
+                      entities.frame, entities.sprites, pos, angle, height, pitch,
+                      WINDOW_WIDTH, WINDOW_HEIGHT, vr.delta_angle, vr.ray_distance,
+                      vr.h_fov, vr.scale_height, False)
+    return draw
+
+# name -> (function returning the callable to time, number of calls per sample, run on every map)
+BENCHMARKS = {
+    'repeat_tiles': (tiles, 1, True),
+    'load_map': (lambda ctx: lambda: load_map('img/map'+str(ctx.map_id)+'_color.png'), 1, True),
+    'bake_shade': (shade, 1, True),
+    'bake_color_map': (color_map, 1, True),
+    'ray_casting[start]': (lambda ctx: render(ctx, 'start', False), 5, True),
+    'ray_casting[low]': (lambda ctx: render(ctx, 'low', False), 5, True),
+    'ray_casting[high]': (lambda ctx: render(ctx, 'high', False), 5, True),
+    'ray_casting_nvg[start]': (lambda ctx: render(ctx, 'start', True), 5, True),
+    'ray_casting_nvg[low]': (lambda ctx: render(ctx, 'low', True), 5, True),
+    'ray_casting_nvg[high]': (lambda ctx: render(ctx, 'high', True), 5, True),
+    'ray_casting_depth_major[start]': (lambda ctx: render(ctx, 'start', False, ray_casting_depth_major), 5, True),
+    'ray_casting_depth_major[low]': (lambda ctx: render(ctx, 'low', False, ray_casting_depth_major), 5, True),
+    'ray_casting_depth_major[high]': (lambda ctx: render(ctx, 'high', False, ray_casting_depth_major), 5, True),
+    'ray_casting_depth_major_nvg[start]': (lambda ctx: render(ctx, 'start', True, ray_casting_depth_major), 5, True),
+    'ray_casting_depth_major_nvg[low]': (lambda ctx: render(ctx, 'low', True, ray_casting_depth_major), 5, True),
+    'ray_casting_depth_major_nvg[high]': (lambda ctx: render(ctx, 'high', True, ray_casting_depth_major), 5, True),
+    'extract_minimap': (minimap, 20, True),
+    'draw_entities[start]': (lambda ctx: draw_aircraft(ctx, 'start'), 20, True),
+    # these change the map, they run after the renderers
+    'create_landing_area': (landing_area, 5, True),
+    'load_level': (lambda ctx: level(ctx, cached=False), 1, True),
+    'load_level[cached]': (lambda ctx: level(ctx, cached=True), 1, True),
+    'paint_landing_area': (landing_area_paint, 50, False),
+    'draw_dashed_line': (dashed_line, 200, False),
+    'draw_player': (draw_player, 50, False),
+}
+
+def benchmark_names(maps):
+    # the map dependent benchmarks are named after the map, e.g. ray_casting[start]@map3
+    names = []
+    for map_id in maps:
+        for name, (_, _, per_map) in BENCHMARKS.items():
+            if per_map:
+                names.append((map_id, name, f'{name}@map{map_id}'))
+            elif map_id == maps[0]:
+                names.append((map_id, name, name))
+    return names
+
+def measure(func, repeat, number, compiled=False):
+    # the first call includes the JIT compilation, unless the kernel already ran on another map
+    start = time.perf_counter()
+    func()
+    warmup = time.perf_counter() - start
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+
+    result = {'median': statistics.median(samples), 'min': min(samples)}
+    if not compiled:
+        result['warmup'] = warmup
+    return result
+
+def run(ctx, names, repeat):
+    results = {}
+    compiled = set()
+    for map_id, name, full_name in names:
+        ctx.map_id = map_id
+        setup, number, _ = BENCHMARKS[name]
+        result = results[full_name] = measure(setup(ctx), repeat, number, name in compiled)
+        compiled.add(name)
+        warmup = f"{result['warmup']*1000:10.2f}" if 'warmup' in result else f"{'-':>10s}"
+        print(f"{full_name:42s} warmup {warmup} ms   median {result['median']*1000:10.3f} ms")
+    return results
+
+def compare(results, baseline, threshold):
+    # return the kernels slower than their baseline by more than the threshold,
+    # and the ones which are not in the baseline (new or renamed)
+    regressions = []
+    missing = []
+    for name, result in results.items():
+        if name not in baseline:
+            missing.append(name)
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions, missing
+
+def machine_info():
+    return {
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'numba': numba.__version__,
+        'pygame': pg.version.ver,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot kernels of the renderer.')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run the benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=7, help='number of timed samples')
+    parser.add_argument('--maps', type=int, nargs='+', default=list(range(NUM_MAPS)),
+                        help='bundled maps to run the map dependent benchmarks on (all by default)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file (JSON)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown over the baseline (0.25 = 25%%)')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--strict', action='store_true',
+                        help='fail when a kernel which ran is not in the baseline')
+    parser.add_argument('--memory', action='store_true',
+                        help='print the memory used by the renderer and exit')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='build the renderer in low memory mode (with --memory)')
+    args = parser.parse_args(argv)
+
+    pg.init()
+    if args.memory:
+        ctx = Context(low_memory=args.low_memory)
+        print(format_memory_report(memory_report(ctx.voxel_render().app)))
+        return 0
+
+    names = [name for name in benchmark_names(args.maps) if args.filter in name[2]]
+    results = run(Context(), names, args.repeat)
+
+    if args.save:
+        baseline = {'info': machine_info(), 'kernels': results}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                previous = json.load(f)
+            # keep the kernels which were not run this time, if they were timed on the same machine
+            if previous.get('info') == baseline['info']:
+                baseline['kernels'] = {**previous['kernels'], **results}
+            else:
+                print(f'{args.baseline} was recorded on another machine, it is replaced')
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'no baseline found, run with --save to create {args.baseline}')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['kernels']
+    regressions, missing = compare(results, baseline, args.threshold)
+    for name in missing:
+        print(f'{"MISSING" if args.strict else "not gated"} {name}: not in the baseline')
+    for name, ratio in regressions:
+        print(f'REGRESSION {name}: {ratio:.2f}x the baseline')
+    return 1 if regressions or (args.strict and missing) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
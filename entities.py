@@ -0,0 +1,121 @@
+import math
+from numba import njit
+import numpy as np
+import pygame as pg
+from settings import *
+
+@njit(fastmath=True)
+def update_entities(pos, angle, speed, height, turn_rate, frame, height_map):
+    # bounds of the playable area (same as the player)
+    low = MAP_SIZE * 2
+    high = MAP_SIZE * (NUM_TILES - 2)
+    span = high - low
+
+    for i in range(pos.shape[0]):
+        # pick a new turn rate from time to time
+        if np.random.random() < 0.01:
+            turn_rate[i] = np.random.uniform(-0.01, 0.01)
+        angle[i] += turn_rate[i]
+
+        # move forward
+        pos[i, 0] += speed[i] * math.cos(angle[i])
+        pos[i, 1] += speed[i] * math.sin(angle[i])
+
+        # wrap around the playable area
+        if pos[i, 0] < low:
+            pos[i, 0] += span
+        elif pos[i, 0] >= high:
+            pos[i, 0] -= span
+        if pos[i, 1] < low:
+            pos[i, 1] += span
+        elif pos[i, 1] >= high:
+            pos[i, 1] -= span
+
+        # follow the terrain at cruise height
+        ground = height_map[int(pos[i, 0]) % height_map.shape[0], int(pos[i, 1]) % height_map.shape[1]][0]
+        height[i] += (ground + AIRCRAFT_CRUISE_HEIGHT - height[i]) * 0.05
+        if height[i] < ground + OBJECT_SIZE:
+            height[i] = ground + OBJECT_SIZE
+
+        # animate the rotor
+        frame[i] = (frame[i] + 1) % 4
+
+@njit(fastmath=True)
+def draw_entities(screen_array, depth_buffer, pos, height, frame, sprites,
+                  player_pos, player_angle, player_height, player_pitch,
+                  screen_width, screen_height, delta_angle, ray_distance, h_fov, scale_height, nvg):
+    cos_p = math.cos(player_angle)
+    sin_p = math.sin(player_angle)
+    sprite_size = sprites.shape[1]
+
+    for i in range(pos.shape[0]):
+        dx = pos[i, 0] - player_pos[0]
+        dy = pos[i, 1] - player_pos[1]
+
+        # perpendicular depth, same as the terrain after the fish eye correction
+        depth = dx * cos_p + dy * sin_p
+        if depth < 1 or depth > ray_distance:
+            continue
+
+        # screen column of the ray passing through the entity
+        rel_angle = math.atan2(dy, dx) - player_angle
+        rel_angle = (rel_angle + math.pi) % (2 * math.pi) - math.pi
+        center_x = (rel_angle + h_fov) / delta_angle
+        center_y = (player_height - height[i]) / depth * scale_height + player_pitch
+
+        # size of the billboard on screen
+        size = AIRCRAFT_SIZE / depth * scale_height
+        if size < 1:
+            continue
+        left = center_x - size / 2
+        top = center_y - size / 2
+
+        x_start = max(0, int(left))
+        x_end = min(screen_width, int(left + size) + 1)
+        y_start = max(0, int(top))
+        y_end = min(screen_height, int(top + size) + 1)
+        if x_start >= x_end or y_start >= y_end:
+            continue
+
+        # draw the sprite, testing each pixel against the terrain depth
+        sprite = sprites[frame[i]]
+        for screen_x in range(x_start, x_end):
+            u = min(sprite_size - 1, int((screen_x - left) * sprite_size / size))
+            for screen_y in range(y_start, y_end):
+                if depth >= depth_buffer[screen_x, screen_y]:
+                    continue
+                v = min(sprite_size - 1, int((screen_y - top) * sprite_size / size))
+                texel = sprite[u, v]
+                if texel[3] < 128:
+                    continue
+                if nvg:
+                    screen_array[screen_x, screen_y] = [0, texel[1], 0]
+                else:
+                    screen_array[screen_x, screen_y] = texel[:3]
+                depth_buffer[screen_x, screen_y] = depth
+    return screen_array
+
+class Entities:
+    def __init__(self, count=NUM_AIRCRAFT):
+        # state of every aircraft, one row per entity
+        self.pos = np.random.uniform(MAP_SIZE * 2, MAP_SIZE * (NUM_TILES - 2), (count, 2))
+        self.angle = np.random.uniform(-math.pi, math.pi, count)
+        self.speed = np.random.uniform(2, 8, count)
+        self.height = np.full(count, 250.0)
+        self.turn_rate = np.random.uniform(-0.01, 0.01, count)
+        self.frame = np.random.randint(0, 4, count)
+
+        # rotor animation frames as RGBA arrays
+        sheet = pg.image.load("img/player.png")
+        self.sprites = np.zeros((4, AIRCRAFT_SPRITE_SIZE, AIRCRAFT_SPRITE_SIZE, 4), dtype=np.uint8)
+        for index, x in enumerate(range(0, 256*4, 256)):
+            rect = pg.Rect((x, 0, 256, 256))
+            image = pg.Surface(rect.size, pg.SRCALPHA, 32)
+            image.blit(sheet, (0, 0), rect)
+            image = pg.transform.smoothscale(image, (AIRCRAFT_SPRITE_SIZE, AIRCRAFT_SPRITE_SIZE))
+            self.sprites[index, :, :, :3] = pg.surfarray.array3d(image)
+            self.sprites[index, :, :, 3] = pg.surfarray.array_alpha(image)
+
+    def update(self, height_map):
+        update_entities(self.pos, self.angle, self.speed, self.height,
+                        self.turn_rate, self.frame, height_map)
@@ -7,8 +7,7 @@ class Explosion:
         self.images = []
         for x in range(0, 1536, 96):
             rect = pg.Rect((x, 0, 96, 96))
-            image = pg.Surface(rect.size, pg.SRCALPHA, 32)
-            image.convert_alpha()
+            image = pg.Surface(rect.size, pg.SRCALPHA, 32).convert_alpha()
             image.blit(sheet, (0, 0), rect)
             self.images.append(image)
 
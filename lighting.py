@@ -0,0 +1,82 @@
+import math
+from numba import njit
+import numpy as np
+from settings import *
+
+def sun_position(hour):
+    # the sun rises in the east (+x) at 6h, is south (+y) at noon and sets in the west at 18h
+    day = (hour - 6) / 12
+    azimuth = math.pi * day
+    elevation = math.sin(math.pi * day) * math.radians(SUN_MAX_ELEVATION)
+    return azimuth, elevation
+
+@njit(fastmath=True, nogil=True)
+def shade_point(height_map, x, y, dir_x, dir_y, sun_x, sun_y, sun_z, sun_slope):
+    map_width = height_map.shape[0]
+    map_height = height_map.shape[1]
+
+    # no direct light at night
+    if sun_z <= 0:
+        return AMBIENT_LIGHT
+
+    # slope of the terrain (the map wraps around)
+    h = height_map[x % map_width, y % map_height][0]
+    gx = (float(height_map[(x + 1) % map_width, y % map_height][0]) -
+          float(height_map[(x - 1) % map_width, y % map_height][0])) / 2
+    gy = (float(height_map[x % map_width, (y + 1) % map_height][0]) -
+          float(height_map[x % map_width, (y - 1) % map_height][0])) / 2
+    diffuse = (sun_z - gx * sun_x - gy * sun_y) / math.sqrt(gx * gx + gy * gy + 1)
+    if diffuse <= 0:
+        return AMBIENT_LIGHT
+
+    # march towards the sun to find the terrain casting a shadow
+    ray_height = float(h)
+    for step in range(1, SHADOW_DISTANCE):
+        ray_height += sun_slope
+        if ray_height > 255:
+            break
+        sx = int(x + step * dir_x) % map_width
+        sy = int(y + step * dir_y) % map_height
+        if height_map[sx, sy][0] > ray_height:
+            return AMBIENT_LIGHT
+
+    return AMBIENT_LIGHT + DIFFUSE_LIGHT * diffuse
+
+@njit(fastmath=True, nogil=True)
+def bake_shade(height_map, x_start, x_end, y_start, y_end, sun_azimuth, sun_elevation):
+    # direction of the sun, on the ground and in the sky
+    dir_x = math.cos(sun_azimuth)
+    dir_y = math.sin(sun_azimuth)
+    sun_x = math.cos(sun_elevation) * dir_x
+    sun_y = math.cos(sun_elevation) * dir_y
+    sun_z = math.sin(sun_elevation)
+    sun_slope = math.tan(sun_elevation) if sun_z > 0 else 0.0
+
+    shade = np.empty((x_end - x_start, y_end - y_start), dtype=np.float32)
+    for x in range(x_start, x_end):
+        for y in range(y_start, y_end):
+            shade[x - x_start, y - y_start] = shade_point(height_map, x, y, dir_x, dir_y,
+                                                          sun_x, sun_y, sun_z, sun_slope)
+    return shade
+
+@njit(fastmath=True, nogil=True)
+def shade_colors(color_map, shade):
+    lit_map = np.empty_like(color_map)
+    for x in range(color_map.shape[0]):
+        for y in range(color_map.shape[1]):
+            for c in range(color_map.shape[2]):
+                lit_map[x, y, c] = min(255, int(color_map[x, y, c] * shade[x, y]))
+    return lit_map
+
+@njit(fastmath=True, nogil=True)
+def relight_region(color_map, color_tile, height_map, x_start, x_end, y_start, y_end,
+                   sun_azimuth, sun_elevation):
+    # bake the light again on part of the map, after the terrain has been edited
+    shade = bake_shade(height_map, x_start, x_end, y_start, y_end, sun_azimuth, sun_elevation)
+    for x in range(x_start, x_end):
+        for y in range(y_start, y_end):
+            source = color_tile[x % color_tile.shape[0], y % color_tile.shape[1]]
+            target = color_map[x % color_map.shape[0], y % color_map.shape[1]]
+            for c in range(color_map.shape[2]):
+                target[c] = min(255, int(source[c] * shade[x - x_start, y - y_start]))
+    return color_map
@@ -1,10 +1,13 @@
+import argparse
 import pygame as pg
 import time
 import math
 import sys
 from player import Player
 from explosion import Explosion
-from voxel_render import VoxelRender
+from entities import Entities
+from voxel_render import VoxelRender, RENDERERS
+from memory import memory_report, format_memory_report
 from settings import *
 
 ###############################################################################
@@ -14,7 +17,8 @@ from settings import *
 ###############################################################################
 
 class App:
-    def __init__(self):
+    def __init__(self, low_memory=LOW_MEMORY):
+        self.low_memory = low_memory
         pg.init()
         pg.mixer.init()   
         pg.mixer.set_num_channels(8)     
@@ -27,6 +31,7 @@ class App:
         self.clock = pg.time.Clock()
         self.player = Player()
         self.explosion = Explosion()
+        self.entities = Entities()
         self.voxel_render = VoxelRender(self)
         self.stage = 0 # (0=intro, 1=game, 2=success, 3=failure)
         self.current_track = 1
@@ -57,6 +62,7 @@ class App:
         if self.stage==1:
             self.player.update()
             self.explosion.update()
+            self.entities.update(self.voxel_render.height_map)
             self.voxel_render.update()
 
     def draw(self):
@@ -124,10 +130,28 @@ class App:
                     # toggle night vision goggles
                     if event.type == pg.KEYDOWN and event.key == pg.K_n:
                         self.player.nvg = not self.player.nvg
+                    # advance the time of day by one hour
+                    if event.type == pg.KEYDOWN and event.key == pg.K_t:
+                        self.voxel_render.set_time_of_day(self.voxel_render.time_of_day + 1)
+                    # switch the renderer (to compare them)
+                    if event.type == pg.KEYDOWN and event.key == pg.K_r:
+                        self.voxel_render.toggle_renderer()
 
             self.clock.tick(60)
-            pg.display.set_caption(f'FPS: {int(self.clock.get_fps())}')
+            pg.display.set_caption(f'FPS: {int(self.clock.get_fps())} ({self.voxel_render.renderer})')
 
 if __name__ == '__main__':
-    app = App()
+    parser = argparse.ArgumentParser(description='VOXEL SKIES')
+    parser.add_argument('--low-memory', action='store_true', default=LOW_MEMORY,
+                        help='use the smallest representation of the maps, frame and sky')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the memory used by each subsystem once loaded')
+    parser.add_argument('--renderer', choices=list(RENDERERS), default=RENDERER,
+                        help='column (one ray per column) or depth (one slice of depth at a time)')
+    args = parser.parse_args()
+
+    app = App(low_memory=args.low_memory)
+    app.voxel_render.renderer = args.renderer
+    if args.memory_report:
+        print(format_memory_report(memory_report(app)))
     app.run()
@@ -0,0 +1,58 @@
+import os
+import pygame as pg
+
+def array_bytes(*arrays):
+    # arrays shared between subsystems are only counted once by the caller
+    return sum(array.nbytes for array in arrays if array is not None)
+
+def surface_bytes(*surfaces):
+    return sum(surface.get_pitch() * surface.get_height() for surface in surfaces if surface is not None)
+
+def sound_bytes(*sounds):
+    if not pg.mixer.get_init():
+        return 0
+    frequency, size, channels = pg.mixer.get_init()
+    return sum(int(sound.get_length() * frequency) * channels * abs(size) // 8 for sound in sounds)
+
+def rss_bytes():
+    # resident memory of the process (Linux only)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def memory_report(app):
+    vr = app.voxel_render
+    player = app.player
+    explosion = app.explosion
+    entities = app.entities
+
+    # the same array can be used by several objects (e.g. the tile is the map in low memory mode)
+    maps = {id(array): array for array in (vr.height_map, vr.color_map, vr.height_tile,
+                                            vr.color_tile, player.height_map,
+                                            *vr.lit_tiles.values())
+            if array is not None}
+
+    return {
+        'maps': array_bytes(*maps.values()),
+        'framebuffer': array_bytes(vr.screen_array, vr.depth_buffer) + surface_bytes(app.screen),
+        'sprites': surface_bytes(*player.images, getattr(app, 'intro', None),
+                                 *(explosion.images if explosion else [])) + array_bytes(entities.sprites),
+        'sky': array_bytes(vr.sky, vr.sky_texture),
+        'audio': sound_bytes(explosion.explosion_sound) if explosion else 0,
+        'entities': array_bytes(entities.pos, entities.angle, entities.speed, entities.height,
+                                entities.turn_rate, entities.frame),
+    }
+
+def format_memory_report(report):
+    lines = ['memory usage:']
+    for name, size in report.items():
+        lines.append(f'  {name:12s} {size / 2**20:8.2f} MB')
+    lines.append(f"  {'total':12s} {sum(report.values()) / 2**20:8.2f} MB")
+
+    # the rest is the interpreter, pygame, numba and the JIT compiled code
+    rss = rss_bytes()
+    if rss is not None:
+        lines.append(f"  {'process RSS':12s} {rss / 2**20:8.2f} MB")
+    return '\n'.join(lines)
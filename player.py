@@ -21,15 +21,14 @@ class Player:
         for y in range(0, 256*3, 256):
             for x in range(0, 256*4, 256):
                 rect = pg.Rect((x, y, 256, 256))
-                image = pg.Surface(rect.size, pg.SRCALPHA, 32)
-                image.convert_alpha()
+                image = pg.Surface(rect.size, pg.SRCALPHA, 32).convert_alpha()
                 image.blit(sheet, (0, 0), rect)
                 self.images.append(image)
 
         self.image = self.images[0]
         self.index = 0
         self.ground_elevation = 0 
-        self.height_map = np.zeros((1024, 1024, 3))
+        self.height_map = None
         self.oscillation = 0
         self.fuel = MAX_FUEL
         self.damages = MAX_DAMAGES
@@ -127,9 +126,13 @@ class Player:
             self.pos[1] = (MAP_SIZE * NUM_TILES / 2) + (MAP_SIZE / 2)
 
         # compute the distance of the landing zone
+        # (to the nearest copy when the map is a single tile)
         x1, y1 = self.pos
         x2, y2 = self.landing_area_pos
-        self.landing_area_dist = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+        width, height = self.height_map.shape[:2]
+        dx = (x2 - x1 + width / 2) % width - width / 2
+        dy = (y2 - y1 + height / 2) % height - height / 2
+        self.landing_area_dist = math.sqrt(dx ** 2 + dy ** 2)
 
         # check if landed
         if self.landing_area_dist<100 and (self.height - self.ground_elevation - OBJECT_SIZE)==0 and self.speed==0:
@@ -154,8 +157,8 @@ class Player:
         self.pos[1] += self.speed * sin_a            
 
         # compute the ground elevation below the helicopter
-        rel_x = int(self.pos[0] % 1024)
-        rel_y = int(self.pos[1] % 1024)
+        rel_x = int(self.pos[0]) % self.height_map.shape[0]
+        rel_y = int(self.pos[1]) % self.height_map.shape[1]
         self.ground_elevation = int(self.height_map[rel_x][rel_y][0])
 
         # check ground collision
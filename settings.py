@@ -14,4 +14,23 @@ NUM_MAPS = 10
 OBJECT_SIZE = 5
 
 MIN_SPEED = -20
-MAX_SPEED = 20
\ No newline at end of file
+MAX_SPEED = 20
+
+NUM_AIRCRAFT = 200
+AIRCRAFT_SIZE = 40
+AIRCRAFT_SPRITE_SIZE = 64
+AIRCRAFT_CRUISE_HEIGHT = 60
+
+TIME_OF_DAY = 14
+SUN_MAX_ELEVATION = 60
+AMBIENT_LIGHT = 0.45
+DIFFUSE_LIGHT = 0.7
+SHADOW_DISTANCE = 128
+LIGHTING_CACHE_SIZE = 8
+
+LANDING_AREA_SIZE = 120
+LANDING_CANDIDATES = 256
+
+LOW_MEMORY = False
+
+RENDERER = 'column'
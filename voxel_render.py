@@ -1,11 +1,14 @@
 import math
 from numba import njit
 import random
+import threading
 import numpy as np
 import pygame as pg
 from settings import *
+from entities import draw_entities
+from lighting import sun_position, bake_shade, shade_colors, relight_region
 
-@njit(fastmath=True)    
+@njit(fastmath=True, nogil=True)    
 def repeat_tiles(height_map, map_size):
     # Get the current dimensions of the original image
     height, width = height_map.shape[:2]
@@ -25,9 +28,71 @@ def repeat_tiles(height_map, map_size):
 
     return new_height_map
 
-def load_map(path):
+def load_tile(path):
     img = pg.image.load(path)
-    return repeat_tiles(pg.surfarray.array3d(img), 10)
+    return pg.surfarray.array3d(img)
+
+def load_map(path):
+    return repeat_tiles(load_tile(path), 10)
+
+def build_flatness_index(height_tile):
+    # summed-area tables of the heights and squared heights of the tile
+    heights = height_tile[:, :, 0].astype(np.int64)
+    index = np.zeros((2, heights.shape[0] + 1, heights.shape[1] + 1), dtype=np.int64)
+    index[0, 1:, 1:] = heights.cumsum(0).cumsum(1)
+    index[1, 1:, 1:] = (heights ** 2).cumsum(0).cumsum(1)
+    return index
+
+def area_statistics(index, x, y, size):
+    # mean and variance of the heights of square areas of the tile, in constant time per area
+    sums = index[:, x + size, y + size] - index[:, x, y + size] - index[:, x + size, y] + index[:, x, y]
+    mean = sums[0] / size ** 2
+    return mean, sums[1] / size ** 2 - mean ** 2
+
+def random_landing_coordinates(count):
+    # coordinates in the playable area, never across the edge of a tile
+    return np.array([MAP_SIZE * random.randint(2, NUM_TILES - 3) +
+                     random.randint(LANDING_AREA_SIZE, MAP_SIZE - LANDING_AREA_SIZE)
+                     for _ in range(count)])
+
+def paint_landing_area(color_map, center_x, center_y):
+    # paint the landing area (H)
+    center_x %= color_map.shape[0]
+    center_y %= color_map.shape[1]
+    color_map[center_x-50:center_x+50, center_y-50:center_y+50] = [255,255,255]
+    color_map[center_x-30:center_x+30, center_y-30:center_y-20] = [255,0,0]
+    color_map[center_x-30:center_x+30, center_y+20:center_y+30] = [255,0,0]
+    color_map[center_x-5:center_x+5, center_y-30:center_y+30] = [255,0,0]
+
+def bake_lit_tile(color_tile, height_tile, sun_azimuth, sun_elevation):
+    # light the terrain once, the renderer then reads the lit colors as they are
+    shade = bake_shade(height_tile, 0, height_tile.shape[0], 0, height_tile.shape[1],
+                       sun_azimuth, sun_elevation)
+    return shade_colors(color_tile, shade)
+
+def build_color_map(lit_tile, color_tile, height_map, landing_area_pos, sun_azimuth, sun_elevation,
+                    num_tiles=10, in_place=False):
+    # the lit tile is left untouched so that it can be cached, unless it is the map itself
+    if num_tiles > 1:
+        color_map = repeat_tiles(lit_tile, num_tiles)
+    elif in_place:
+        color_map = lit_tile
+    else:
+        color_map = lit_tile.copy()
+
+    # the landing area has been flattened, light it again with its surroundings
+    x, y = landing_area_pos
+    margin = LANDING_AREA_SIZE // 2 + SHADOW_DISTANCE
+    relight_region(color_map, color_tile, height_map, x - margin, x + margin, y - margin, y + margin,
+                   sun_azimuth, sun_elevation)
+    paint_landing_area(color_map, x, y)
+    return color_map
+
+def bake_color_map(color_tile, height_tile, height_map, landing_area_pos, sun_azimuth, sun_elevation,
+                   num_tiles=10):
+    lit_tile = bake_lit_tile(color_tile, height_tile, sun_azimuth, sun_elevation)
+    return build_color_map(lit_tile, color_tile, height_map, landing_area_pos, sun_azimuth, sun_elevation,
+                           num_tiles, in_place=True)
 
 def extract_minimap(color_map, x, y):
     # convert parameters to integers
@@ -44,7 +109,12 @@ def extract_minimap(color_map, x, y):
     y_end = min(color_map.shape[1], y + size)
 
     # extract the color map
-    cropped_map = color_map[x_start:x_end, y_start:y_end, :]
+    if x_end - x_start == 2 * size and y_end - y_start == 2 * size:
+        cropped_map = color_map[x_start:x_end, y_start:y_end, :]
+    else:
+        # the map is a single tile which wraps around (low memory mode)
+        cropped_map = color_map.take(range(x - size, x + size), axis=0, mode='wrap')
+        cropped_map = cropped_map.take(range(y - size, y + size), axis=1, mode='wrap')
       
     # create a pygame surface from a RGB array
     surface = pg.surfarray.make_surface(cropped_map)
@@ -52,13 +122,7 @@ def extract_minimap(color_map, x, y):
     return surface
 
 @njit(fastmath=True)
-def ray_casting(screen_array, player_pos, player_angle, player_height, player_pitch,
-                     screen_width, screen_height, delta_angle, ray_distance, h_fov, scale_height, 
-                     color_map, height_map, sky_texture, scroll_x, nvg):
-
-    map_height = len(height_map[0])
-    map_width = len(height_map)
-
+def draw_sky(screen_array, depth_buffer, sky_texture, scroll_x, nvg):
     if not nvg:
         # width of the sky image
         width_sky = sky_texture.shape[0]
@@ -78,6 +142,19 @@ def ray_casting(screen_array, player_pos, player_angle, player_height, player_pi
         # dark sky (NVG mode)
         screen_array[:] = 0
 
+    # the sky is infinitely far away
+    depth_buffer[:] = np.inf
+
+@njit(fastmath=True)
+def ray_casting(screen_array, depth_buffer, player_pos, player_angle, player_height, player_pitch,
+                     screen_width, screen_height, delta_angle, ray_distance, h_fov, scale_height, 
+                     color_map, height_map, sky_texture, scroll_x, nvg):
+
+    map_height = len(height_map[0])
+    map_width = len(height_map)
+
+    draw_sky(screen_array, depth_buffer, sky_texture, scroll_x, nvg)
+
     y_buffer = np.full(screen_width, screen_height)
 
     ray_angle = player_angle - h_fov
@@ -91,39 +168,130 @@ def ray_casting(screen_array, player_pos, player_angle, player_height, player_pi
 
         for depth in range(1, ray_distance):
             x = int(player_pos[0] + depth * cos_a)
-            if 0 < x < map_width:
-                y = int(player_pos[1] + depth * sin_a)
-                if 0 < y < map_height:
-
-                    # remove fish eye and get height on screen
-                    depth *= math.cos(player_angle - ray_angle)
-                    height_on_screen = int((player_height - height_map[x, y][0]) /
-                                           depth * scale_height + player_pitch)
-
-                    # remove unnecessary drawing
-                    if not first_contact:
-                        y_buffer[num_ray] = min(height_on_screen, screen_height)
-                        first_contact = True
-                    # remove mirror bug
-                    if height_on_screen < 0:
-                        height_on_screen = 0
-
-                    # draw vert line
-                    if height_on_screen < y_buffer[num_ray]:
-                        if nvg:
-                            for screen_y in range(height_on_screen, y_buffer[num_ray]):
-                                # Set NVG color directly
-                                screen_array[num_ray, screen_y] = [0.0, max(0,color_map[x, y][1]-random.randint(0,30)), 0.0]
-                        else:
-                            object_color = color_map[x, y]
-                            for screen_y in range(height_on_screen, y_buffer[num_ray]):
-                                screen_array[num_ray, screen_y] = object_color
-
-                        y_buffer[num_ray] = height_on_screen
+            y = int(player_pos[1] + depth * sin_a)
+            if not (0 <= x < map_width and 0 <= y < map_height):
+                # the map wraps around (single tile in low memory mode)
+                x %= map_width
+                y %= map_height
+
+            # remove fish eye and get height on screen
+            depth *= math.cos(player_angle - ray_angle)
+            height_on_screen = int((player_height - height_map[x, y][0]) /
+                                   depth * scale_height + player_pitch)
+
+            # remove unnecessary drawing
+            if not first_contact:
+                y_buffer[num_ray] = min(height_on_screen, screen_height)
+                first_contact = True
+            # remove mirror bug
+            if height_on_screen < 0:
+                height_on_screen = 0
+
+            # draw vert line
+            if height_on_screen < y_buffer[num_ray]:
+                if nvg:
+                    for screen_y in range(height_on_screen, y_buffer[num_ray]):
+                        # Set NVG color directly
+                        screen_array[num_ray, screen_y] = [0.0, max(0,color_map[x, y][1]-random.randint(0,30)), 0.0]
+                        depth_buffer[num_ray, screen_y] = depth
+                else:
+                    object_color = color_map[x, y]
+                    for screen_y in range(height_on_screen, y_buffer[num_ray]):
+                        screen_array[num_ray, screen_y] = object_color
+                        depth_buffer[num_ray, screen_y] = depth
+
+                y_buffer[num_ray] = height_on_screen
 
         ray_angle += delta_angle
     return screen_array
 
+@njit(fastmath=True)
+def ray_casting_depth_major(screen_array, depth_buffer, player_pos, player_angle, player_height, player_pitch,
+                            screen_width, screen_height, delta_angle, ray_distance, h_fov, scale_height,
+                            color_map, height_map, sky_texture, scroll_x, nvg):
+    # close to the picture of ray_casting, but the map is walked one depth slice at a time
+    # (front to back) for all the columns, and stops once every column is covered
+    # (the samples land at other depths, about 17 to 25% of the pixels differ on maps 0-3)
+
+    map_height = len(height_map[0])
+    map_width = len(height_map)
+
+    draw_sky(screen_array, depth_buffer, sky_texture, scroll_x, nvg)
+
+    # direction of each ray, scaled so that one step is one unit of depth (no fish eye)
+    cos_p = math.cos(player_angle)
+    sin_p = math.sin(player_angle)
+    step_x = np.empty(screen_width)
+    step_y = np.empty(screen_width)
+    for num_ray in range(screen_width):
+        tan_a = math.tan(num_ray * delta_angle - h_fov)
+        step_x[num_ray] = cos_p - tan_a * sin_p
+        step_y[num_ray] = sin_p + tan_a * cos_p
+
+    # the first slice only sets the bottom of each column (remove unnecessary drawing)
+    y_buffer = np.empty(screen_width, dtype=np.int64)
+    open_columns = 0
+    for num_ray in range(screen_width):
+        x = int(player_pos[0] + step_x[num_ray]) % map_width
+        y = int(player_pos[1] + step_y[num_ray]) % map_height
+        height_on_screen = int((player_height - height_map[x, y][0]) * scale_height + player_pitch)
+        y_buffer[num_ray] = min(height_on_screen, screen_height)
+        if y_buffer[num_ray] > 0:
+            open_columns += 1
+
+    xs = np.empty(screen_width)
+    ys = np.empty(screen_width)
+    for depth in range(2, ray_distance):
+        # every column is covered, nothing further away can be seen
+        if open_columns == 0:
+            break
+
+        # map coordinates of the whole slice
+        for num_ray in range(screen_width):
+            xs[num_ray] = player_pos[0] + depth * step_x[num_ray]
+            ys[num_ray] = player_pos[1] + depth * step_y[num_ray]
+        scale = scale_height / depth
+
+        for num_ray in range(screen_width):
+            if y_buffer[num_ray] <= 0:
+                continue
+
+            x = int(xs[num_ray])
+            y = int(ys[num_ray])
+            if not (0 <= x < map_width and 0 <= y < map_height):
+                # the map wraps around (single tile in low memory mode)
+                x %= map_width
+                y %= map_height
+
+            height_on_screen = int((player_height - height_map[x, y][0]) * scale + player_pitch)
+            # remove mirror bug
+            if height_on_screen < 0:
+                height_on_screen = 0
+
+            # draw vert line
+            if height_on_screen < y_buffer[num_ray]:
+                if nvg:
+                    for screen_y in range(height_on_screen, y_buffer[num_ray]):
+                        screen_array[num_ray, screen_y] = [0.0, max(0,color_map[x, y][1]-random.randint(0,30)), 0.0]
+                        depth_buffer[num_ray, screen_y] = depth
+                else:
+                    object_color = color_map[x, y]
+                    for screen_y in range(height_on_screen, y_buffer[num_ray]):
+                        screen_array[num_ray, screen_y] = object_color
+                        depth_buffer[num_ray, screen_y] = depth
+
+                y_buffer[num_ray] = height_on_screen
+                if height_on_screen == 0:
+                    open_columns -= 1
+
+    return screen_array
+
+# renderers which can be selected at runtime
+RENDERERS = {
+    'column': ray_casting,
+    'depth': ray_casting_depth_major,
+}
+
 
 def draw_rect_alpha(surface, color, rect):
     shape_surf = pg.Surface(pg.Rect(rect).size, pg.SRCALPHA)
@@ -212,68 +380,171 @@ class VoxelRender:
         self.app = app
         self.player = app.player
         self.explosion = app.explosion
+        self.entities = app.entities
+        self.low_memory = app.low_memory
+        self.num_tiles = 1 if self.low_memory else 10
         self.fov = math.pi / 4
         self.h_fov = self.fov / 4
         self.num_rays = app.width
         self.delta_angle = self.fov / self.num_rays
         self.ray_distance = 1800
+        self.renderer = RENDERER
         self.scale_height = 340
-        self.screen_array = np.full((app.width, app.height, 3), (0, 0, 0))
+        if self.low_memory:
+            self.screen_array = np.zeros((app.width, app.height, 3), dtype=np.uint8)
+        else:
+            self.screen_array = np.full((app.width, app.height, 3), (0, 0, 0))
+        self.depth_buffer = np.full((app.width, app.height), np.inf, dtype=np.float32)
         self.hud_font_small = pg.freetype.Font("./fonts/lcd.ttf", 16)
         self.map_id = 0
-        self.height_map = load_map('img/map'+str(self.map_id)+'_height.png')
-        self.color_map = load_map('img/map'+str(self.map_id)+'_color.png')
-        self.player.height_map = self.height_map
+        self.level_count = 0
+        self.time_of_day = TIME_OF_DAY
+        self.baked_color_map = None
+        self.bake_thread = None
+        self.lit_time_of_day = None
+        self.lit_tiles = {}
+        # no cache in low memory mode, the lit tile is the color map
+        self.lit_tiles_size = 0 if self.low_memory else LIGHTING_CACHE_SIZE
+        self.lit_tiles_lock = threading.Lock()
         self.sky_offset_x = 0
         sky_image = pg.image.load('img/sky.png')
-        resized_sky_image = pg.transform.scale(sky_image, (self.app.width * 3, self.app.height))
-        self.sky = pg.surfarray.array3d(resized_sky_image)
-        self.create_landing_area()
-
-    def create_landing_area(self):
-        # place a random landing area on the map (H)
-        center = random.randint(MAP_SIZE*2+120, MAP_SIZE * (NUM_TILES - 2)-120)
-
-        for y in range(-50, 50):
-            for x in range(-50,50):
-                self.color_map[center-y, center-x] = [255,255,255]
-                
-        for y in range(-60, 60):
-            for x in range(-60,60):               
-                self.height_map[center-y, center-x] = [0,0,0]
-
-        for y in range(-30, 30):
-            for x in range(-30,-20):
-                self.color_map[center-y, center-x] = [255,0,0]
-            for x in range(20,30):
-                self.color_map[center-y, center-x] = [255,0,0]
-        for y in range(-5, 5):
-            for x in range(-30,30):
-                self.color_map[center-y, center-x] = [255,0,0]
-
-        self.player.landing_area_pos = (center,center)
-
+        if self.low_memory:
+            # keep the sky at its own width, the visible slice is scaled every frame
+            resized_sky_image = pg.transform.scale(sky_image, (sky_image.get_width(), self.app.height))
+            self.sky_texture = pg.surfarray.array3d(resized_sky_image)
+            self.sky = np.zeros((self.app.width, self.app.height, 3), dtype=np.uint8)
+        else:
+            resized_sky_image = pg.transform.scale(sky_image, (self.app.width * 3, self.app.height))
+            self.sky_texture = None
+            self.sky = pg.surfarray.array3d(resized_sky_image)
+        self.load_level()
+
+    # load the maps of the current level and bake their lighting
+    def load_level(self):
+        self.height_tile = load_tile('img/map'+str(self.map_id)+'_height.png')
+        self.color_tile = load_tile('img/map'+str(self.map_id)+'_color.png')
+        if self.low_memory:
+            # a single tile which wraps around, with one channel for the heights (the lighting
+            # is not cached, so it is baked from the map with the landing area)
+            self.height_tile = np.ascontiguousarray(self.height_tile[:, :, :1])
+            self.height_map = self.height_tile
+        else:
+            self.height_map = repeat_tiles(self.height_tile, self.num_tiles)
+        # only needed to place the landing area, it is freed once the level is loaded
+        self.create_landing_area(build_flatness_index(self.height_tile))
+        self.color_map = self.bake_color_map(self.time_of_day, *self.level_state())
+        self.lit_time_of_day = self.time_of_day
+        self.player.height_map = self.height_map
+        self.level_count += 1
+
+    def create_landing_area(self, flatness_index):
+        # place the landing area (H) on the flattest of random candidate areas
+        half = LANDING_AREA_SIZE // 2
+        xs = random_landing_coordinates(LANDING_CANDIDATES)
+        ys = random_landing_coordinates(LANDING_CANDIDATES)
+        # the candidates never cross the edge of a tile, the index of a single tile is enough
+        mean, variance = area_statistics(flatness_index, xs % self.height_tile.shape[0] - half,
+                                         ys % self.height_tile.shape[1] - half, LANDING_AREA_SIZE)
+        best = np.argmin(variance)
+        x, y = int(xs[best]), int(ys[best])
+
+        # flatten the ground at the mean height of the area
+        map_x = x % self.height_map.shape[0]
+        map_y = y % self.height_map.shape[1]
+        self.height_map[map_x-half:map_x+half, map_y-half:map_y+half] = round(mean[best])
+
+        self.player.landing_area_pos = (x,y)
+
+    # maps of the current level, the bake thread gets its own references to them
+    # so that a level loaded meanwhile cannot be mixed with the one being baked
+    def level_state(self):
+        return self.map_id, self.color_tile, self.height_tile, self.height_map, self.player.landing_area_pos
+
+    # lit tile of a map, baked once per map and hour
+    def lit_tile(self, time_of_day, map_id, color_tile, height_tile):
+        key = (map_id, time_of_day)
+        with self.lit_tiles_lock:
+            lit_tile = self.lit_tiles.get(key)
+        if lit_tile is None:
+            lit_tile = bake_lit_tile(color_tile, height_tile, *sun_position(time_of_day))
+            if self.lit_tiles_size > 0:
+                with self.lit_tiles_lock:
+                    self.lit_tiles[key] = lit_tile
+                    # forget the oldest ones
+                    while len(self.lit_tiles) > self.lit_tiles_size:
+                        del self.lit_tiles[next(iter(self.lit_tiles))]
+        return lit_tile
+
+    # color map of a level, only the landing area is lit again when the tile is cached
+    def bake_color_map(self, time_of_day, map_id, color_tile, height_tile, height_map, landing_area_pos):
+        return build_color_map(self.lit_tile(time_of_day, map_id, color_tile, height_tile), color_tile,
+                               height_map, landing_area_pos, *sun_position(time_of_day), self.num_tiles,
+                               in_place=self.lit_tiles_size == 0)
+
+    # change the time of day, the lighting is baked again in the background
+    def set_time_of_day(self, hour):
+        self.time_of_day = hour % 24
+        self.start_bake()
+
+    def start_bake(self):
+        # one bake at a time, update() starts the next one if the time of day changed meanwhile
+        if self.bake_thread is None or not self.bake_thread.is_alive():
+            self.bake_thread = threading.Thread(target=self.bake_in_background,
+                                                args=(self.level_count, self.time_of_day, self.level_state()),
+                                                daemon=True)
+            self.bake_thread.start()
+
+    def bake_in_background(self, level_count, time_of_day, level_state):
+        color_map = self.bake_color_map(time_of_day, *level_state)
+        self.baked_color_map = (level_count, time_of_day, color_map)
 
     def update(self):
+        # swap in the lighting baked in the background
+        if self.baked_color_map is not None:
+            level_count, time_of_day, color_map = self.baked_color_map
+            self.baked_color_map = None
+            # a new level has been lit when loaded
+            if level_count == self.level_count:
+                self.color_map = color_map
+                self.lit_time_of_day = time_of_day
+        if self.lit_time_of_day != self.time_of_day:
+            self.start_bake()
+
         # update the sky location
         self.sky_offset_x += int(self.player.roll/5)
+        sky_offset_x = self.sky_offset_x
+        if self.sky_texture is not None:
+            # scale the visible slice of the sky
+            columns = (np.arange(self.app.width) + self.sky_offset_x) * self.sky_texture.shape[0] // (self.app.width * 3)
+            np.take(self.sky_texture, columns, axis=0, out=self.sky, mode='wrap')
+            sky_offset_x = 0
 
         # ray trace the scenery
-        self.screen_array = ray_casting(self.screen_array, self.player.pos, self.player.angle,
+        self.screen_array = RENDERERS[self.renderer](self.screen_array, self.depth_buffer, self.player.pos, self.player.angle,
                                         self.player.height, self.player.pitch, self.app.width,
                                         self.app.height, self.delta_angle, self.ray_distance,
                                         self.h_fov, self.scale_height, self.color_map, self.height_map, 
-                                        self.sky, self.sky_offset_x, self.player.nvg)
+                                        self.sky, sky_offset_x, self.player.nvg)
+
+        # draw the other aircraft, hidden by the terrain in front of them
+        self.screen_array = draw_entities(self.screen_array, self.depth_buffer, self.entities.pos,
+                                          self.entities.height, self.entities.frame, self.entities.sprites,
+                                          self.player.pos, self.player.angle, self.player.height,
+                                          self.player.pitch, self.app.width, self.app.height,
+                                          self.delta_angle, self.ray_distance, self.h_fov,
+                                          self.scale_height, self.player.nvg)
+
+    # switch between the column and depth major renderers
+    def toggle_renderer(self):
+        names = list(RENDERERS)
+        self.renderer = names[(names.index(self.renderer) + 1) % len(names)]
 
     # load the next map
     def change_map(self):
         self.map_id = self.map_id + 1
         if self.map_id >= NUM_MAPS:
             self.map_id = 0
-        self.height_map = load_map('img/map'+str(self.map_id)+'_height.png')
-        self.color_map = load_map('img/map'+str(self.map_id)+'_color.png')
-        self.create_landing_area()
-        self.player.height_map = self.height_map
+        self.load_level()
         self.player.fuel = MAX_FUEL
         self.player.height = 250
         self.player.pos = np.array([(MAP_SIZE*NUM_TILES/2), MAP_SIZE*NUM_TILES/2], dtype=float)